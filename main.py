@@ -1,6 +1,15 @@
-from fastapi import FastAPI, Request, Header, HTTPException
-from collections import defaultdict
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import JSONResponse
+from collections import OrderedDict
+from heapq import nlargest
+from operator import itemgetter
+import asyncio
+import hmac
 import os
+import secrets
+
+import orjson
+import xxhash
 
 app = FastAPI(
     title="Sales Aggregation Service",
@@ -9,76 +18,189 @@ app = FastAPI(
 
 API_KEY = os.getenv("API_KEY")
 
+# Header values arrive as latin-1 bytes, so the key is compared in that
+# encoding; a key outside latin-1 could never match any request.
+try:
+    API_KEY_BYTES = API_KEY.encode("latin-1") if API_KEY else None
+except UnicodeEncodeError:
+    raise RuntimeError(
+        "API_KEY must only contain latin-1 characters"
+    ) from None
+
+# Largest request body accepted; bigger payloads are rejected with 413
+# before any buffer is allocated for them.
+MAX_BODY_SIZE = 128 * 1024 * 1024
+
+# Most of a declared Content-Length reserved before body bytes arrive; the
+# buffer grows past this only as data is actually received.
+BODY_PREALLOCATE_SIZE = 4 * 1024 * 1024
+
+# Summaries of recently aggregated payloads, keyed by the raw body's length
+# and its xxh3-128 digest, so retried batches skip the aggregation pass. The
+# per-process seed keeps clients from constructing colliding bodies.
+RESULT_CACHE_SIZE = 128
+_RESULT_CACHE_SEED = secrets.randbits(64)
+_result_cache = OrderedDict()
+
+
+class ORJSONResponse(JSONResponse):
+    """
+    JSON response rendered with orjson instead of the stdlib encoder.
+    """
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+
+def _parse_decimal128(value):
+    try:
+        return float(value["$numberDecimal"])
+    except (KeyError, TypeError, ValueError):
+        return 0.0
+
+
+_PRICE_PARSERS = {
+    float: float,
+    int: float,
+    bool: float,
+    dict: _parse_decimal128,
+}
+
 
 def parse_price(value):
     """
     Handles MongoDB Decimal128 and normal numeric values safely.
     """
-    if isinstance(value, (int, float)):
-        return float(value)
+    parser = _PRICE_PARSERS.get(type(value))
+    return parser(value) if parser else 0.0
 
-    if isinstance(value, dict) and "$numberDecimal" in value:
-        try:
-            return float(value["$numberDecimal"])
-        except (TypeError, ValueError):
-            return 0.0
 
-    return 0.0
+def _body_too_large():
+    return HTTPException(
+        status_code=413,
+        detail="Request body exceeds the maximum allowed size"
+    )
 
 
-@app.get("/health")
-def health():
-    return {"status": "ok"}
+async def read_body(request: Request):
+    """
+    Reads the request body into a single buffer, reserving up to
+    BODY_PREALLOCATE_SIZE from Content-Length up front so received chunks
+    are copied in place instead of being collected and joined.
+    """
+    try:
+        size = int(request.headers["content-length"])
+    except (KeyError, ValueError):
+        size = -1
 
+    if size > MAX_BODY_SIZE:
+        raise _body_too_large()
 
-@app.post("/api/aggregate-invoices")
-async def aggregate_sales(
-    request: Request,
-    x_api_key: str = Header(None)
-):
-    if API_KEY and x_api_key != API_KEY:
-        raise HTTPException(status_code=401, detail="Unauthorized")
+    buffer = bytearray(max(0, min(size, BODY_PREALLOCATE_SIZE)))
+    offset = 0
 
-    sales = await request.json()
+    async for chunk in request.stream():
+        end = offset + len(chunk)
+        if 0 <= size < end:
+            raise HTTPException(
+                status_code=400,
+                detail="Request body exceeds Content-Length"
+            )
+        if end > MAX_BODY_SIZE:
+            raise _body_too_large()
+        buffer[offset:end] = chunk
+        offset = end
 
-    if not isinstance(sales, list):
-        raise HTTPException(
-            status_code=400,
-            detail="Expected a list of sales documents"
-        )
+    del buffer[offset:]
+    return buffer
+
+
+def _aggregate_items_tolerant(
+    items,
+    item_revenue: dict,
+    sale_total: float
+) -> float:
+    """
+    Slow path for items with missing or malformed fields; adds their revenue
+    to item_revenue and returns sale_total including it.
+    """
+    for item in items:
+        price = parse_price(item.get("price"))
+        try:
+            quantity = int(item.get("quantity", 0))
+        except (TypeError, ValueError):
+            quantity = 0
+
+        revenue = price * quantity
+        sale_total += revenue
+        name = item.get("name", "unknown")
+        item_revenue[name] = item_revenue.get(name, 0.0) + revenue
+
+    return sale_total
+
+
+def _aggregate(sales: list) -> dict:
+    """
+    Computes the sales summary for a list of sale documents.
 
+    CPU-bound; the endpoint runs it in a worker thread so the event loop
+    stays free while large batches are processed.
+    """
     invoice_count = 0
     total_sales = 0.0
     online_sales = 0.0
     in_store_sales = 0.0
     coupon_orders = 0
 
-    item_revenue = defaultdict(float)
-    store_revenue = defaultdict(float)
+    item_revenue = {}
+    store_revenue = {}
+    store_rank = {}
+    item_revenue_get = item_revenue.get
+    store_revenue_get = store_revenue.get
+    top_store = "data not available"
+    top_store_revenue = 0.0
 
     for sale in sales:
         if not sale or "items" not in sale:
             continue
 
+        items = sale["items"]
         sale_total = 0.0
+        done = 0
 
-        for item in sale.get("items", []):
-            price = parse_price(item.get("price"))
-            try:
-                quantity = int(item.get("quantity", 0))
-            except (TypeError, ValueError):
-                quantity = 0
-
-            revenue = price * quantity
-            sale_total += revenue
-            item_revenue[item.get("name", "unknown")] += revenue
+        try:
+            for item in items:
+                revenue = parse_price(item["price"]) * int(item["quantity"])
+                name = item["name"]
+                item_revenue[name] = item_revenue_get(name, 0.0) + revenue
+                sale_total += revenue
+                done += 1
+        except (KeyError, TypeError, ValueError):
+            sale_total = _aggregate_items_tolerant(
+                items[done:], item_revenue, sale_total
+            )
 
         if sale_total <= 0:
             continue
 
         invoice_count += 1
         total_sales += sale_total
-        store_revenue[sale.get("storeLocation", "unknown")] += sale_total
+        store = sale.get("storeLocation", "unknown")
+        store_total = store_revenue_get(store)
+        if store_total is None:
+            store_rank[store] = len(store_rank)
+            store_total = sale_total
+        else:
+            store_total += sale_total
+        store_revenue[store] = store_total
+
+        # Ties go to the store seen first, matching max() over store_revenue.
+        if store_total > top_store_revenue or (
+            store_total == top_store_revenue
+            and store_rank[store] < store_rank[top_store]
+        ):
+            top_store_revenue = store_total
+            top_store = store
 
         if sale.get("purchaseMethod") == "Online":
             online_sales += sale_total
@@ -88,30 +210,92 @@ async def aggregate_sales(
         if sale.get("couponUsed"):
             coupon_orders += 1
 
-    top_items = sorted(
-        item_revenue.items(),
-        key=lambda x: x[1],
-        reverse=True
-    )[:3]
+    top_items = nlargest(3, item_revenue.items(), key=itemgetter(1))
 
-    top_store = (
-        max(store_revenue, key=store_revenue.get)
-        if store_revenue else "data not available"
-    )
+    _round = round
 
     return {
         "invoice_count": invoice_count,
-        "total_sales": round(total_sales, 2),
+        "total_sales": _round(total_sales, 2),
         "average_invoice_value": (
-            round(total_sales / invoice_count, 2)
+            _round(total_sales / invoice_count, 2)
             if invoice_count > 0 else 0
         ),
-        "online_sales": round(online_sales, 2),
-        "in_store_sales": round(in_store_sales, 2),
+        "online_sales": _round(online_sales, 2),
+        "in_store_sales": _round(in_store_sales, 2),
         "coupon_orders": coupon_orders,
         "top_store": top_store,
         "top_items": [
-            {"name": name, "revenue": round(revenue, 2)}
+            {"name": name, "revenue": _round(revenue, 2)}
             for name, revenue in top_items
         ]
     }
+
+
+@app.get("/health")
+def health():
+    return {"status": "ok"}
+
+
+async def aggregate_sales(request: Request):
+    raw = await read_body(request)
+    key = (len(raw), xxhash.xxh3_128_digest(raw, _RESULT_CACHE_SEED))
+
+    cached = _result_cache.get(key)
+    if cached is not None:
+        _result_cache.move_to_end(key)
+        return ORJSONResponse(cached)
+
+    sales = await asyncio.to_thread(orjson.loads, raw)
+
+    if not isinstance(sales, list):
+        raise HTTPException(
+            status_code=400,
+            detail="Expected a list of sales documents"
+        )
+
+    result = await asyncio.to_thread(_aggregate, sales)
+
+    _result_cache[key] = result
+    if len(_result_cache) > RESULT_CACHE_SIZE:
+        _result_cache.popitem(last=False)
+
+    return ORJSONResponse(result)
+
+
+def _raw_api_key(request: Request) -> bytes:
+    """
+    Returns the x-api-key header exactly as received, without decoding.
+    """
+    for name, value in request.scope["headers"]:
+        if name == b"x-api-key":
+            return value
+
+    return b""
+
+
+async def aggregate_sales_authenticated(request: Request):
+    if not hmac.compare_digest(_raw_api_key(request), API_KEY_BYTES):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    return await aggregate_sales(request)
+
+
+# Without an API key there is nothing to check, so the open variant is
+# registered and the x-api-key header is never looked at. The header is read
+# straight from the request, so it is declared for OpenAPI by hand.
+app.add_api_route(
+    "/api/aggregate-invoices",
+    aggregate_sales_authenticated if API_KEY else aggregate_sales,
+    methods=["POST"],
+    response_class=ORJSONResponse,
+    openapi_extra={
+        "parameters": [
+            {
+                "name": "x-api-key",
+                "in": "header",
+                "schema": {"type": "string"}
+            }
+        ]
+    } if API_KEY else None
+)